@@ -1,25 +1,174 @@
 # %%
-import base64
 import datetime
+import functools
+import hashlib
 import json
+import logging
+import mimetypes
 import os
+import tempfile
+import threading
+import types
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
 from dotenv import load_dotenv
 import requests
 import yaml
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # SIMD 対応の pybase64 があれば使う (API は標準の base64 と互換)
+    import pybase64 as b64
+except ImportError:
+    import base64 as b64
+
+try:
+    # 大きな base64 文字列を含む JSON は orjson の方が高速にシリアライズできる
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # libyaml が使える場合は C 実装の Loader/Dumper を使う
+    from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
 
 # %%
 
+logger = logging.getLogger(__name__)
+
+
+def configure_logging():
+    """このモジュールのログ (保存先パスなど) を INFO レベルで標準エラーに出力する
+
+    ルートロガーは変更しないため、他のライブラリの INFO ログは出力されない
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# 接続を使い回して TLS ハンドシェイクをリクエストごとに行わないようにする
+_SESSION = requests.Session()
+_SESSION.headers.update({"Connection": "keep-alive"})
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    # 画像生成の POST は冪等でなく課金されるため、リクエストが届いていないことが
+    # 確実な接続エラーと 429 (レート制限) のみリトライする
+    max_retries=Retry(
+        total=3,
+        read=0,
+        other=0,
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ),
+))
+
+
+# base64 は 3 バイト単位で変換されるため、チャンクサイズは 3 の倍数にする
+# (途中のチャンクにパディング '=' が入らないようにするため。バッファ付きの read は
+#  EOF 以外で指定サイズより短く返らないので、ファイルはバッファ付きで開くこと)
+_ENCODE_CHUNK_SIZE = 57 * 1024
+
 
 def encode_image_to_base64(image_path):
+    encoded = bytearray()
     with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+        while chunk := image_file.read(_ENCODE_CHUNK_SIZE):
+            encoded += b64.b64encode(chunk)
+    return encoded.decode('ascii')
+
+
+# base64 エンコード結果のキャッシュ (合計サイズで上限を設け、古いものから破棄する)
+_ENCODE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+_encode_cache = OrderedDict()
+_encode_cache_bytes = 0
+_encode_cache_lock = threading.Lock()
+
+
+def encode_image_to_base64_cached(image_path):
+    """同じ画像ファイルの base64 エンコード結果を使い回す"""
+    global _encode_cache_bytes
+
+    # mtime と size をキーに含め、ファイルが更新された場合は再エンコードさせる
+    stat = os.stat(image_path)
+    key = (str(image_path), stat.st_mtime_ns, stat.st_size)
+
+    with _encode_cache_lock:
+        if key in _encode_cache:
+            _encode_cache.move_to_end(key)
+            return _encode_cache[key]
+
+    encoded = encode_image_to_base64(image_path)
+
+    # 上限を超える大きさの画像はキャッシュしない
+    if len(encoded) > _ENCODE_CACHE_MAX_BYTES:
+        return encoded
+
+    with _encode_cache_lock:
+        if key not in _encode_cache:
+            _encode_cache[key] = encoded
+            _encode_cache_bytes += len(encoded)
+            while _encode_cache_bytes > _ENCODE_CACHE_MAX_BYTES:
+                _, evicted = _encode_cache.popitem(last=False)
+                _encode_cache_bytes -= len(evicted)
+    return encoded
+
+
+# アップロード済み画像の URL (キーはアップロード先と画像データのハッシュの組)
+_UPLOADED_IMAGE_URLS = {}
+
+
+@functools.lru_cache(maxsize=128)
+def _upload_image_cached(image_path, mtime_ns, size, object_store_url):
+    # mtime_ns と size はキャッシュキーとしてのみ使う (ファイル更新時に再アップロードさせるため)
+    image_data = Path(image_path).read_bytes()
+    digest = hashlib.blake2b(image_data, digest_size=16).hexdigest()
+
+    # 別パスでも同じ内容の画像は同じアップロード先にはアップロードし直さない
+    uploaded_key = (object_store_url, digest)
+    if uploaded_key in _UPLOADED_IMAGE_URLS:
+        return _UPLOADED_IMAGE_URLS[uploaded_key]
+
+    suffix = Path(image_path).suffix.lower()
+    upload_url = f"{object_store_url.rstrip('/')}/{digest}{suffix}"
+    content_type = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+    response = _SESSION.put(upload_url, data=image_data,
+                            headers={"Content-Type": content_type}, timeout=(10, 300))
+    response.raise_for_status()
+
+    _UPLOADED_IMAGE_URLS[uploaded_key] = upload_url
+    return upload_url
+
+
+def _maybe_upload(image_path):
+    """入力画像をリクエストに埋め込む URL を返す
+
+    環境変数 OBJECT_STORE_URL が設定されている場合は画像をそこへ PUT して公開 URL を返し、
+    設定されていない場合は base64 の data URL を返す
+    """
+    object_store_url = os.getenv("OBJECT_STORE_URL")
+    if object_store_url:
+        stat = os.stat(image_path)
+        return _upload_image_cached(str(image_path), stat.st_mtime_ns, stat.st_size, object_store_url)
+    return f"data:image/jpeg;base64,{encode_image_to_base64_cached(image_path)}"
 
 
 def get_image_from_base64(base64_image):
-    return Image.open(BytesIO(base64.b64decode(base64_image)))
+    image = Image.open(BytesIO(b64.b64decode(base64_image, validate=False)))
+    # 遅延デコードにせず、ここで一括でデコードしておく
+    image.load()
+    return image
 
 
 def show_image_from_base64(base64_image):
@@ -28,59 +177,197 @@ def show_image_from_base64(base64_image):
 
 def base64_url_to_base64_image(base64_url):
     # data:image/{format};base64,{data} 形式から base64 データを抽出
-    if ";base64," in base64_url:
-        return base64_url.split(";base64,", 1)[1]
+    # (bytes の場合は bytes のまま扱い、文字列との相互変換を避ける)
+    marker = b";base64," if isinstance(base64_url, (bytes, bytearray)) else ";base64,"
+    index = base64_url.find(marker)
+    if index >= 0:
+        return base64_url[index + len(marker):]
     return base64_url  # すでに base64 データの場合はそのまま返す
 
 
-def save_base64_url_to_file(base64_url, output_path):
-    base64_image = base64_url_to_base64_image(base64_url)
-    image_data = base64.b64decode(base64_image)
-    
-    # 画像フォーマットを自動判別
+# 先頭のマジックバイトから判別できる画像フォーマットと拡張子
+_IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+
+def detect_image_extension(image_data):
+    """画像データのマジックバイトから拡張子を判別する (判別できない場合は None)"""
+    header = image_data[:12]
+    for signature, extension in _IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def save_image_data_to_file(image_data, output_path):
+    """デコード済みの画像データを保存し、保存先パスを返す"""
+    output_path = Path(output_path)
+
+    # マジックバイトで判別できればデコードせずにそのまま書き出す
+    format_extension = detect_image_extension(image_data)
+    if format_extension:
+        output_path = output_path.with_suffix(f'.{format_extension}')
+        output_path.write_bytes(image_data)
+        return output_path
+
+    # 判別できない場合は PIL で画像フォーマットを自動判別 (ヘッダーのみ読むためピクセルはデコードされない)
     image = Image.open(BytesIO(image_data))
     
     # 出力パスの拡張子を画像フォーマットに合わせる
-    output_path = Path(output_path)
-    format_extension = image.format.lower() if image.format else 'png'
+    format_extension = image.format.lower()
     if format_extension == 'jpeg':
         format_extension = 'jpg'
     output_path = output_path.with_suffix(f'.{format_extension}')
     
-    # 画像を保存
-    image.save(output_path)
+    # 元データがそのまま正しいファイルになるので再エンコードしない
+    output_path.write_bytes(image_data)
     return output_path
 
 
-def image_generation_request(messages, model, openrouter_api_key=None):
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {openrouter_api_key or os.getenv('OPENROUTER_API_KEY')}",
+def save_base64_url_to_file(base64_url, output_path):
+    base64_image = base64_url_to_base64_image(base64_url)
+    image_data = b64.b64decode(base64_image, validate=False)
+    return save_image_data_to_file(image_data, output_path)
+
+
+def load_yaml(stream):
+    """YAMLを読み込む (yaml.safe_load 相当)"""
+    return yaml.load(stream, Loader=_YamlLoader)
+
+
+def dump_yaml(data):
+    """YAML文字列に変換する"""
+    return yaml.dump(data, Dumper=_YamlDumper, allow_unicode=True)
+
+
+def _json_dumps_bytes(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+
+def _json_dumps_indent_bytes(data):
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode("utf-8")
+
+
+def parse_response_json(response):
+    """APIレスポンスの本文をJSONとしてパースする"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+class _CachedResponse:
+    """キャッシュから読み込んだレスポンス (requests.Response の一部を模倣)"""
+
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _get_response_cache_dir():
+    """レスポンスキャッシュの保存先 (環境変数 RESPONSE_CACHE_DIR が未設定の場合は None)"""
+    cache_dir = os.getenv("RESPONSE_CACHE_DIR")
+    return Path(cache_dir) if cache_dir else None
+
+
+def _has_response_images(response):
+    """レスポンスに生成画像が含まれているか
+
+    数MBのレスポンスを JSON パースし直さないよう、画像エントリのキーの有無だけを見る
+    """
+    return b'"image_url"' in response.content
+
+
+def _write_response_cache(cache_path, content):
+    # 書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # キャッシュの保存に失敗してもレスポンス自体は返す
+        logger.warning("Failed to write response cache %s: %s", cache_path, e)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@functools.lru_cache(maxsize=8)
+def _request_headers(openrouter_api_key):
+    # APIキーごとにヘッダーを一度だけ組み立てて使い回す (共有されるので読み取り専用にする)
+    return types.MappingProxyType({
+        "Authorization": f"Bearer {openrouter_api_key}",
         "Content-Type": "application/json"
-    }
+    })
+
+
+def _response_cache_key(payload):
+    # orjson の有無でシリアライズ結果が変わらないよう、標準 json の正規形でハッシュする
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=True, separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode("ascii"), digest_size=32).hexdigest()
+
+
+def image_generation_request(messages, model, openrouter_api_key=None, use_cache=True):
+    url = "https://openrouter.ai/api/v1/chat/completions"
+    headers = _request_headers(openrouter_api_key or os.getenv('OPENROUTER_API_KEY'))
 
     payload = {
         "model": model,
         "messages": messages,
         "modalities": ["image", "text"]
     }
-
-    response = requests.post(url, headers=headers,
-                             json=payload, timeout=(10, 300))
+    body = _json_dumps_bytes(payload)
+
+    # 同じリクエスト内容のレスポンスがキャッシュにあれば API を呼ばずに返す
+    cache_dir = _get_response_cache_dir() if use_cache else None
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = cache_dir / f"{_response_cache_key(payload)}.json"
+        if cache_path.exists():
+            return _CachedResponse(cache_path.read_bytes())
+
+    response = _SESSION.post(url, headers=headers,
+                             data=body, timeout=(10, 300))
+
+    # 画像が生成されなかったレスポンス (200 でも失敗扱い) はキャッシュしない
+    if cache_path is not None and response.status_code == 200 and _has_response_images(response):
+        _write_response_cache(cache_path, response.content)
     return response
 
-def save_response_images(output_base_folder, response_data, prompt_info_data):
+def save_response_images(output_base_folder, response_data, prompt_info_data, return_images=False):
     """レスポンスの画像をファイルに保存し、保存したパスリストを返す
     
     Args:
         output_base_folder: 出力先ベースフォルダ
         response_data: パース済みのレスポンスJSON
         prompt_info_data: プロンプト情報
+        return_images: True の場合、保存した画像を PIL Image としても返す
     
     Returns:
-        tuple: (output_folder_path, saved_image_paths)
+        tuple: (output_folder_path, saved_images)
             - output_folder_path: 保存先フォルダパス
-            - saved_image_paths: 保存した画像ファイルのパスリスト
+            - saved_images: (保存した画像ファイルのパス, PIL Image) のリスト
+              PIL Image は保存時にデコードしたデータから開いたもの
+              (return_images が False の場合や開けない場合は None)
     """
     images = response_data.get("choices", [])[0].get(
         "message", {}).get("images", [])
@@ -91,30 +378,56 @@ def save_response_images(output_base_folder, response_data, prompt_info_data):
 
     id = response_data.get("id", "unknown_id")
 
-    today_folder = output_base_folder / yyyymmdd_hy
-    today_folder.mkdir(parents=True, exist_ok=True)
-    output_folder_path = today_folder
-    output_json_path = output_folder_path / f"{yyyymmddhhmmss}_{id}_response.json"
-
+    output_folder_path = output_base_folder / yyyymmdd_hy
     output_folder_path.mkdir(parents=True, exist_ok=True)
-    output_json_path.write_text(json.dumps(
-        response_data, indent=2), encoding="utf-8")
+    # ファイル名の共通部分は一度だけ組み立てる
+    prefix = f"{yyyymmddhhmmss}_{id}"
+    output_json_path = output_folder_path / f"{prefix}_response.json"
+    prompt_info_output_path = output_folder_path / f"{prefix}_prompt_info.yaml"
 
-    saved_image_paths = []
-    for idx, image_info in enumerate(images):
+    def save_image(idx, image_info):
         base64_response = image_info["image_url"]["url"]
-        output_image_path = output_folder_path / f"{yyyymmddhhmmss}_{id}_{idx}"
-        saved_path = save_base64_url_to_file(base64_response, output_image_path)
-        print(f"Saved image to {saved_path}")
-        saved_image_paths.append(saved_path)
-
-    # prompt_info.yamlを保存
-    prompt_info_output_path = output_folder_path / f"{yyyymmddhhmmss}_{id}_prompt_info.yaml"
-    prompt_info_output_path.write_text(yaml.dump(prompt_info_data, allow_unicode=True), encoding="utf-8")
-
-    return output_folder_path, saved_image_paths
-
-def unified_image_preview_request(prompt_text, image_paths, model, openrouter_api_key):
+        image_data = b64.b64decode(base64_url_to_base64_image(base64_response), validate=False)
+        output_image_path = output_folder_path / f"{prefix}_{idx}"
+        saved_path = save_image_data_to_file(image_data, output_image_path)
+        logger.info("Saved image to %s", saved_path)
+
+        if not return_images:
+            return saved_path, None
+
+        # 表示用に同じデータから PIL Image を開く (base64 の再デコードを避ける)
+        try:
+            pil_image = Image.open(BytesIO(image_data))
+        except Exception as e:
+            logger.warning("Failed to open saved image %s: %s", saved_path, e)
+            pil_image = None
+        return saved_path, pil_image
+
+    # レスポンスJSON・prompt_info.yaml・画像の書き込みをまとめて並列に実行する
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        json_future = executor.submit(
+            output_json_path.write_bytes, _json_dumps_indent_bytes(response_data))
+        yaml_future = executor.submit(
+            prompt_info_output_path.write_text, dump_yaml(prompt_info_data), encoding="utf-8")
+        image_futures = [
+            executor.submit(save_image, idx, image_info)
+            for idx, image_info in enumerate(images)
+        ]
+        saved_images = [future.result() for future in image_futures]
+        json_future.result()
+        yaml_future.result()
+
+    return output_folder_path, saved_images
+
+def _build_messages(prompt_text, image_urls):
+    # 画像がない場合はテキストのみのコンテンツになる
+    return [{"role": "user", "content": [
+        {"type": "text", "text": prompt_text},
+        *({"type": "image_url", "image_url": {"url": image_url}} for image_url in image_urls),
+    ]}]
+
+
+def unified_image_preview_request(prompt_text, image_paths, model, openrouter_api_key, use_cache=True):
     """画像生成リクエストを送信する統合関数
     
     Args:
@@ -122,33 +435,57 @@ def unified_image_preview_request(prompt_text, image_paths, model, openrouter_ap
         image_paths: 入力画像のパスリスト（空のリストも可）
         model: 使用するモデル名
         openrouter_api_key: OpenRouter APIキー
+        use_cache: レスポンスキャッシュ (RESPONSE_CACHE_DIR) を使うか
     
     Returns:
         APIレスポンス
     """
-    text_content = {"type": "text", "text": prompt_text}
-
-    # 画像がある場合のみ画像コンテンツを追加
-    image_contents = [
-        {
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{encode_image_to_base64(path)}"
-            }
-        }
-        for path in image_paths
-    ] if image_paths else []
-
-    # コンテンツを構築（画像がない場合はテキストのみ）
-    content = [text_content, *image_contents] if image_contents else [text_content]
-
-    messages = [
-        {"role": "user", "content": content}
-    ]
-
-    response = image_generation_request(messages, model=model, openrouter_api_key=openrouter_api_key)
+    # 複数画像のエンコード/アップロードは並列に実行する (ex.map なので順序は保たれる)
+    image_urls = []
+    if image_paths:
+        with ThreadPoolExecutor(max_workers=min(8, len(image_paths))) as executor:
+            image_urls = list(executor.map(_maybe_upload, image_paths))
+
+    messages = _build_messages(prompt_text, image_urls)
+
+    response = image_generation_request(messages, model=model, openrouter_api_key=openrouter_api_key,
+                                        use_cache=use_cache)
     return response
 
+def batch_image_preview_request(prompts_and_paths, model, openrouter_api_key, concurrency=8, use_cache=True):
+    """複数の画像生成リクエストを並列に送信する
+
+    Args:
+        prompts_and_paths: (プロンプトテキスト, 入力画像のパスリスト) のリスト
+        model: 使用するモデル名
+        openrouter_api_key: OpenRouter APIキー
+        concurrency: 同時に送信するリクエスト数の上限
+        use_cache: レスポンスキャッシュ (RESPONSE_CACHE_DIR) を使うか
+
+    Returns:
+        入力と同じ順序のAPIレスポンスのリスト
+        (失敗したリクエストはレスポンスの代わりに発生した例外が入る)
+    """
+    if not prompts_and_paths:
+        return []
+
+    max_workers = max(1, min(concurrency, len(prompts_and_paths)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(unified_image_preview_request, prompt_text, image_paths, model, openrouter_api_key,
+                            use_cache=use_cache)
+            for prompt_text, image_paths in prompts_and_paths
+        ]
+
+        # 1件の失敗で他の (課金済みの) レスポンスを失わないよう、例外はその要素として返す
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
 def gemini_pro_3_image_preview_request(prompt_text, image_paths, openrouter_api_key):
     """Gemini Pro 3を使用した画像生成リクエスト"""
     return unified_image_preview_request(prompt_text, image_paths, "google/gemini-3-pro-image-preview", openrouter_api_key)
@@ -167,6 +504,7 @@ def flux_klein_image_preview_request(prompt_text, image_paths, openrouter_api_ke
 
 def main():
     load_dotenv()
+    configure_logging()
 
     OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
     OUTPUT_BASE_FOLDER = os.getenv("OUTPUT_BASE_FOLDER")
@@ -174,21 +512,35 @@ def main():
 
     prompt_info_path = Path("prompt_info.yaml")
     with prompt_info_path.open("r", encoding="utf-8") as f:
-        prompt_info = yaml.safe_load(f)
-        prompt_text = prompt_info.get("text", "")
-        image_paths = prompt_info.get("image_paths", [])
-
-    image_paths = [path.strip('"') for path in image_paths]
-
-    response = gemini_pro_3_image_preview_request(prompt_text, image_paths, OPENROUTER_API_KEY)
-
-    if response.status_code != 200:
-        print(f"Error: {response.status_code}")
-        print(response.text)
-        return
-
-    response_data = response.json()
-    save_response_images(OUTPUT_BASE_FOLDER, response_data, prompt_info)
+        prompt_info = load_yaml(f)
+
+    # prompt_info.yaml はリスト形式で複数のプロンプトをまとめて指定できる
+    prompt_infos = prompt_info if isinstance(prompt_info, list) else [prompt_info]
+
+    prompts_and_paths = []
+    for info in prompt_infos:
+        prompt_text = info.get("text", "")
+        image_paths = [path.strip('"') for path in info.get("image_paths", [])]
+        prompts_and_paths.append((prompt_text, image_paths))
+
+    responses = batch_image_preview_request(
+        prompts_and_paths, "google/gemini-3-pro-image-preview", OPENROUTER_API_KEY)
+
+    for idx, (info, response) in enumerate(zip(prompt_infos, responses)):
+        if isinstance(response, Exception):
+            print(f"Error (entry {idx}): {response}")
+            continue
+
+        if response.status_code != 200:
+            print(f"Error (entry {idx}): {response.status_code}")
+            print(response.text)
+            continue
+
+        try:
+            response_data = parse_response_json(response)
+            save_response_images(OUTPUT_BASE_FOLDER, response_data, info)
+        except Exception as e:
+            print(f"Error (entry {idx}): failed to save response: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,8 +3,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 from PIL import Image
 import gradio as gr
-import yaml
-from core import gemini_pro_3_image_preview_request, flux_2_pro_image_preview_request, speedream_4_5_image_preview_request, flux_klein_image_preview_request, save_response_images, get_image_from_base64, base64_url_to_base64_image
+from core import gemini_pro_3_image_preview_request, flux_2_pro_image_preview_request, speedream_4_5_image_preview_request, flux_klein_image_preview_request, save_response_images, parse_response_json, load_yaml, configure_logging
 from utility import (
     add_to_history,
     get_history_choices,
@@ -12,12 +11,22 @@ from utility import (
     remove_from_favorites,
     is_favorite,
     get_history_gallery,
-    load_image_preview,
-    check_image_path,
+    check_and_load_image_preview,
     handle_image_upload
 )
 
 
+# 生成画像ギャラリーに表示するサムネイルの最大サイズ (フル解像度の画像は保存先ファイルを参照)
+GALLERY_THUMBNAIL_SIZE = (512, 512)
+
+
+def make_gallery_thumbnail(image):
+    """ギャラリー表示用に縮小した画像を返す"""
+    # thumbnail は内部で draft を呼ぶため、JPEGはフル解像度でデコードされない
+    image.thumbnail(GALLERY_THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    return image
+
+
 def select_from_gallery(evt: gr.SelectData, displayed_paths):
     """ギャラリーから画像を選択したときの処理
     
@@ -95,7 +104,12 @@ prompt_info.yamlを読み込んでフォームに流し込む"""
         file_path = Path(file.name) if hasattr(file, 'name') else Path(file)
 
         with file_path.open("r", encoding="utf-8") as f:
-            prompt_info = yaml.safe_load(f)
+            prompt_info = load_yaml(f)
+
+        # リスト形式 (CLIでの一括実行用) の場合は先頭のエントリのみ読み込む
+        if isinstance(prompt_info, list):
+            gr.Info(f"prompt_info.yamlに{len(prompt_info)}件のエントリがあります。先頭のエントリのみ読み込みました")
+            prompt_info = prompt_info[0]
 
         prompt_text = prompt_info.get("text", "")
         image_paths = prompt_info.get("image_paths", [])
@@ -134,6 +148,11 @@ prompt_info.yamlを読み込んでフォームに流し込む"""
         return "", *empty_paths, *empty_previews, *empty_rows, 1
 
 
+def check_image_path_warnings(*image_paths):
+    """全ての画像パスの存在チェックを行い、警告メッセージのリストを返す"""
+    return [check_and_load_image_preview(path)[0] for path in image_paths]
+
+
 def run_request(output_folder, api_key, model, prompt, *args):
     """リクエストを実行して結果を返す
     
@@ -197,15 +216,15 @@ def run_request(output_folder, api_key, model, prompt, *args):
         if response.status_code != 200:
             return create_error_response(f"エラー: {response.status_code}\n{response.text}")
 
-        response_data = response.json()
+        response_data = parse_response_json(response)
         
         prompt_info_data = {
             "text": prompt,
             "image_paths": valid_image_paths
         }
 
-        output_folder_path, saved_image_paths = save_response_images(
-            Path(output_folder), response_data, prompt_info_data
+        output_folder_path, saved_images = save_response_images(
+            Path(output_folder), response_data, prompt_info_data, return_images=True
         )
 
         # レスポンスから結果テキストを取得
@@ -227,14 +246,12 @@ def run_request(output_folder, api_key, model, prompt, *args):
             result += f"生成された画像数: {len(images)}\n"
             result += f"保存先: {output_folder_path}"
 
-        # 保存済みファイルからPIL画像を読み込み（base64デコードの重複処理を回避）
-        pil_images = []
-        for saved_path in saved_image_paths:
-            try:
-                pil_image = Image.open(saved_path)
-                pil_images.append(pil_image)
-            except Exception as e:
-                print(f"Failed to load saved image {saved_path}: {e}")
+        # 保存時にデコードしたPIL画像をそのまま使う（base64デコードの重複処理を回避）
+        # ギャラリーにはサムネイルのみを渡す
+        pil_images = [
+            make_gallery_thumbnail(pil_image)
+            for _, pil_image in saved_images if pil_image is not None
+        ]
         
         # ドロップダウンとギャラリーの更新は省略（次回のユーザー操作時に自動更新される）
         # これによりファイル保存完了後の待ち時間を最小化
@@ -250,6 +267,7 @@ def run_request(output_folder, api_key, model, prompt, *args):
 
 def create_ui():
     load_dotenv()
+    configure_logging()
 
     default_output_folder = os.getenv("OUTPUT_BASE_FOLDER", "")
     default_api_key = os.getenv("OPENROUTER_API_KEY", "")
@@ -394,22 +412,26 @@ def create_ui():
                     image_previews.append(preview)
 
             # パス入力時のチェックとプレビュー更新
-            image_path.change(
-                fn=check_image_path,
+            # (入力中の1文字ごとには実行せず、履歴からの選択時と入力欄からフォーカスが外れた時のみ実行する)
+            image_path.select(
+                fn=check_and_load_image_preview,
                 inputs=[image_path],
-                outputs=[warning]
+                outputs=[warning, preview]
             )
-            image_path.change(
-                fn=load_image_preview,
+            image_path.blur(
+                fn=check_and_load_image_preview,
                 inputs=[image_path],
-                outputs=[preview]
+                outputs=[warning, preview]
             )
             
-            # 画像アップロード時の処理
+            # 画像アップロード時の処理 (保存先のパスは必ず存在するので警告を消す)
             image_upload.change(
                 fn=handle_image_upload,
                 inputs=[image_upload],
                 outputs=[image_path, preview]
+            ).then(
+                fn=lambda: "",
+                outputs=[warning]
             )
             
             # フィルター切り替え時にギャラリーを更新
@@ -431,6 +453,9 @@ def create_ui():
                 fn=select_from_gallery,
                 inputs=[gallery_path_state],
                 outputs=[image_path, preview]
+            ).then(
+                fn=lambda: "",
+                outputs=[warning]
             )
         
         # 画像フォーム追加・削除ボタン
@@ -483,6 +508,10 @@ def create_ui():
             fn=load_prompt_info,
             inputs=[prompt_info_file],
             outputs=[prompt, *image_path_inputs, *image_previews, *image_rows, visible_count]
+        ).then(
+            fn=check_image_path_warnings,
+            inputs=image_path_inputs,
+            outputs=image_path_warnings
         )
 
         # カスタムCSS
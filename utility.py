@@ -166,28 +166,25 @@ def get_history_gallery(filter_mode="all"):
     return gallery_items, displayed_paths
 
 
-def load_image_preview(path):
-    """画像パスからプレビューを読み込む"""
-    if not path or path.strip() == "":
-        return None
+def check_and_load_image_preview(path):
+    """画像パスの存在チェックとプレビュー読み込みをまとめて行う
 
-    path = path.strip('"')
+    Returns:
+        tuple: (warning, preview)
+            - warning: パスが存在しない場合の警告メッセージ (問題なければ空文字)
+            - preview: プレビュー用のPIL Image (読み込めない場合は None)
+    """
+    if not path or path.strip().strip('"') == "":
+        return "", None
+
+    path = path.strip().strip('"')
+    if not Path(path).exists():
+        return f"⚠️ パスが存在しません: {path}", None
 
     try:
-        if Path(path).exists():
-            return Image.open(path)
-        return None
+        return "", Image.open(path)
     except Exception:
-        return None
-
-
-def check_image_path(path):
-    """画像パスが存在するかチェック"""
-    if not path or path.strip() or path.strip('"') == "":
-        return ""
-    if not Path(path).exists():
-        return f"⚠️ パスが存在しません: {path}"
-    return ""
+        return "", None
 
 
 def handle_image_upload(image):